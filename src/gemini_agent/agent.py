@@ -1,18 +1,173 @@
+import asyncio
+import atexit
+import copy
+import hashlib
+import importlib.util
 import inspect
 import json
+import queue
+import threading
+import time
+import weakref
+from collections import OrderedDict
 from datetime import datetime
-from functools import wraps
-from typing import Any, Callable, Dict, List, Optional, Type, Union, Collection
+from functools import partial, wraps
+from typing import Any, AsyncIterator, Callable, Coroutine, Dict, List, Optional, Tuple, Type, Union, Collection
 
 
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
 
 
 
+try:
+    import orjson
+except ImportError:  # orjson is an optional speedup, fall back to the stdlib
+    orjson = None
+
+try:
+    import httpx
+except ImportError:  # httpx is optional, aprompt() then uses the shared requests session
+    httpx = None
+
+try:
+    import uvloop
+except ImportError:  # uvloop is optional and not available on Windows
+    uvloop = None
+
 load_dotenv()
 
 
+# Transient API errors, retried by both the requests session and aprompt()'s httpx client
+_RETRY_STATUSES: Tuple[int, ...] = (429, 500, 502, 503, 504)
+_MAX_RETRIES: int = 2
+_RETRY_BACKOFF: float = 0.2  # Seconds before the first retry, doubled for each further one
+
+
+async def _close_on_loop_shutdown(client: "httpx.AsyncClient") -> AsyncIterator[None]:
+    """Closes an httpx client once its event loop shuts down its async generators."""
+    try:
+        yield
+    finally:
+        await client.aclose()
+
+
+def _as_requests_response(response: "httpx.Response") -> requests.Response:
+    """Copies an httpx response into a requests.Response, so aprompt() errors match prompt()'s."""
+    converted = requests.Response()
+    converted.status_code = response.status_code
+    converted.reason = response.reason_phrase
+    converted.headers = CaseInsensitiveDict(response.headers)
+    converted.url = str(response.url)
+    converted.encoding = response.encoding
+    converted._content = response.content
+    return converted
+
+
+def _as_requests_error(error: "httpx.TransportError") -> requests.exceptions.RequestException:
+    """Maps an httpx transport error to the requests exception prompt() raises for it."""
+    if isinstance(error, httpx.ConnectTimeout):
+        return requests.exceptions.ConnectTimeout(str(error))
+    if isinstance(error, httpx.ReadTimeout):
+        return requests.exceptions.ReadTimeout(str(error))
+    if isinstance(error, httpx.TimeoutException):
+        return requests.exceptions.Timeout(str(error))
+    return requests.exceptions.ConnectionError(str(error))
+
+
+def _create_http_session(retry_post: bool = True) -> requests.Session:
+    """
+    Creates a pooled HTTP session shared by all agents, retrying transient API errors.
+
+    With retry_post=False, POSTs are only retried if the connection failed, for requests
+    that must not be repeated after the server may have acted on them.
+    """
+    session = requests.Session()
+    retries = Retry(
+        total=_MAX_RETRIES,
+        backoff_factor=_RETRY_BACKOFF,
+        status_forcelist=list(_RETRY_STATUSES),
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | ({"POST"} if retry_post else set()),
+        raise_on_status=False,  # Let the caller turn the final error response into HTTPError
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retries))
+    session.headers["Content-Type"] = "application/json"
+    return session
+
+
+# Debug files are written by a background thread so disk I/O stays off the prompt loop
+_debug_write_queue: "queue.SimpleQueue[Optional[Tuple[str, bytes]]]" = queue.SimpleQueue()
+_debug_writer: Optional[threading.Thread] = None
+_debug_writer_lock = threading.Lock()
+
+
+def _debug_writer_loop() -> None:
+    """Writes queued debug files in order until a None sentinel arrives."""
+    while True:
+        item = _debug_write_queue.get()
+        if item is None:
+            return
+        file_name, data = item
+        try:
+            with open(file_name, "wb") as f:
+                f.write(data)
+        except OSError as e:
+            print(f"Warning: Failed to write debug file {file_name}: {e}")
+
+
+def _drain_debug_writes() -> None:
+    """Waits for all queued debug files to be written; registered to run at exit."""
+    _debug_write_queue.put(None)
+    if _debug_writer is not None:
+        _debug_writer.join()
+
+
+def _write_debug_file(file_name: str, data: bytes) -> None:
+    """Queues a debug file write, starting the writer thread on first use."""
+    global _debug_writer
+    with _debug_writer_lock:
+        if _debug_writer is None:
+            _debug_writer = threading.Thread(
+                target=_debug_writer_loop, name="gemini-agent-debug-writer", daemon=True
+            )
+            _debug_writer.start()
+            atexit.register(_drain_debug_writes)
+    _debug_write_queue.put_nowait((file_name, data))
+
+
+def _json_dumps(obj: Any) -> bytes:
+    """Serializes an object to JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            pass  # e.g. ints wider than 64 bits, which the stdlib encoder handles
+    return json.dumps(obj, allow_nan=False).encode("utf-8")
+
+
+def _json_loads(data: Union[str, bytes]) -> Any:
+    """Parses JSON text, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _parse_json_text(text: str) -> Any:
+    """
+    Parses a JSON answer from the model, also accepting one wrapped in a Markdown code fence.
+
+    Raises json.JSONDecodeError if the text is not JSON.
+    """
+    stripped = text.strip()
+    if stripped.startswith("```") and stripped.endswith("```"):
+        # Drop the opening fence (and its optional language tag) and the closing fence
+        stripped = stripped[3:-3].split("\n", 1)[-1] if "\n" in stripped else stripped[3:-3]
+    return _json_loads(stripped)
+
+
 class Agent:
     PYTHON_TO_GEMINI_TYPE_MAP: Dict[Type, str] = {
         str: "STRING",
@@ -23,6 +178,41 @@ class Agent:
         dict: "OBJECT",
     }
     _tools_registry: Dict[str, Dict[str, Any]] = {}  # Class-level registry
+    # Fixed text of the system prompt around the list of stored variables
+    _SYSTEM_PROMPT_PRELUDE: str = """
+
+        Available variables:
+        """
+    _SYSTEM_PROMPT_EPILOGUE: str = """
+        
+        IMPORTANT - Variable Usage:
+        When you need to use a stored variable in a function call, you MUST use the following syntax:
+        - For function arguments: {"variable": "variable_name"}
+        - For example, if you want to use the 'current_user' variable in a function call:
+          {"user_id": {"variable": "current_user"}}
+        
+        Remember:
+        - Always perform one operation at a time
+        - Use intermediate results from previous steps
+        - If a step requires multiple tools, execute them sequentially
+        - If you're unsure about the next step, explain your reasoning
+        - You can use both stored variables and values from the prompt
+        - When using stored variables, ALWAYS use the {"variable": "variable_name"} syntax
+        """
+    _JSON_ANSWER_INSTRUCTION: str = (
+        "When you give your final answer (after any function calls), respond with valid JSON only."
+    )
+    # Payload fields a cachedContent stands in for
+    _CACHED_PAYLOAD_FIELDS: Tuple[str, ...] = ("system_instruction", "tools", "toolConfig")
+    _http_session: requests.Session = _create_http_session()  # Shared keep-alive connection pool
+    # A cachedContents create that failed with a 5xx may still have made a cache, so it isn't
+    # retried; deletes go through the same session
+    _cache_http_session: requests.Session = _create_http_session(retry_post=False)
+    _CACHE_EXPIRY_MARGIN: int = 5  # Seconds before its TTL ends that a cache counts as expired
+    # Event loop -> (its httpx client for aprompt(), the generator that closes it with the loop)
+    _async_http_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Tuple[httpx.AsyncClient, AsyncIterator[None]]]" = (
+        weakref.WeakKeyDictionary()
+    )
 
     def get_gemini_type(self, py_type: Type) -> str:
         """Maps Python types to Gemini JSON schema types."""
@@ -71,7 +261,12 @@ class Agent:
         return decorator
 
     def __init__(
-        self, api_key: str, tools: Optional[List[Callable[..., Any]]] = None, model_name: str = "gemini-1.5-flash"
+        self,
+        api_key: str,
+        tools: Optional[List[Callable[..., Any]]] = None,
+        model_name: str = "gemini-1.5-flash",
+        context_cache_ttl: Optional[int] = None,
+        response_cache_size: int = 0,
     ) -> None:
         """
         Initializes the Agent using REST API calls.
@@ -80,9 +275,20 @@ class Agent:
             api_key: Your Google Generative AI API key.
             tools: A list of Python functions or class methods decorated as tools.
             model_name: The name of the Gemini model to use.
+            context_cache_ttl: If set, the system instruction and tool declarations are
+                uploaded once as Gemini cached content that lives for this many seconds,
+                and requests reference the cache instead of resending them. Must be more
+                than 5 seconds.
+            response_cache_size: Number of prompt results to keep in memory. A prompt made
+                again with identical arguments and agent state returns the stored result
+                without calling the API. 0 (the default) disables the cache.
         """
         if not api_key:
             raise ValueError("API key is required.")
+        if context_cache_ttl and context_cache_ttl <= self._CACHE_EXPIRY_MARGIN:
+            raise ValueError(
+                f"context_cache_ttl must be more than {self._CACHE_EXPIRY_MARGIN} seconds."
+            )
         self.api_key = api_key
         self.model_name = model_name
         self.base_url = f"https://generativelanguage.googleapis.com/v1beta/models/{self.model_name}"
@@ -93,6 +299,20 @@ class Agent:
         self._tool_instances: Dict[str, Any] = {}  # Store instances for class methods
         self._intermediate_results: Dict[str, Any] = {}  # Store intermediate results
         self._stored_variables: Dict[str, Dict[str, Any]] = {}  # Store variables with metadata
+        self._variables_version: int = 0  # Bumped whenever _stored_variables changes
+        self._system_prompt_cache: Optional[Tuple[int, str]] = None  # (variables version, prompt)
+        # (contents list, JSON of each entry already sent) for the running prompt
+        self._encoded_contents: Optional[Tuple[List[Dict[str, Any]], List[bytes]]] = None
+        # (payload, its cachedContent, JSON of its fields other than contents) for the running prompt
+        self._encoded_payload_fields: Optional[Tuple[Dict[str, Any], Optional[str], bytes]] = None
+        self.context_cache_ttl = context_cache_ttl
+        self.response_cache_size = response_cache_size
+        # key -> (result, contents entries the prompt added), least recently used first
+        self._response_cache: "OrderedDict[bytes, Tuple[Any, List[Dict[str, Any]]]]" = OrderedDict()
+        self._cache_name: Optional[str] = None  # Name of the current cachedContents resource
+        self._cache_key: Optional[str] = None  # Hash of what the cache was created from
+        self._cache_expiry: float = 0.0  # time.monotonic() deadline for the cache
+        self._cache_retry_after: float = 0.0  # No new cache is tried before this after a failure
 
         if tools:
             self._process_tools(tools)
@@ -204,6 +424,7 @@ class Agent:
             "type": type_hint or type(value).__name__,
             "created_at": datetime.now().isoformat(),
         }
+        self._variables_version += 1
 
         return name
 
@@ -233,6 +454,10 @@ class Agent:
 
     def _get_system_prompt(self) -> str:
         """Returns a system prompt that guides the model in breaking down complex operations."""
+        # The prompt only depends on the stored variables, so reuse it until they change
+        if self._system_prompt_cache and self._system_prompt_cache[0] == self._variables_version:
+            return self._system_prompt_cache[1]
+
         variables_info = "\n".join(
             [
                 f"- {name}: {data['description']} (Type: {data['type']})"
@@ -240,35 +465,11 @@ class Agent:
             ]
         )
 
-        return """
-
-        Available variables:
-        {variables_list}
-        
-        IMPORTANT - Variable Usage:
-        When you need to use a stored variable in a function call, you MUST use the following syntax:
-        - For function arguments: {{"variable": "variable_name"}}
-        - For example, if you want to use the 'current_user' variable in a function call:
-          {{"user_id": {{"variable": "current_user"}}}}
-        
-        Remember:
-        - Always perform one operation at a time
-        - Use intermediate results from previous steps
-        - If a step requires multiple tools, execute them sequentially
-        - If you're unsure about the next step, explain your reasoning
-        - You can use both stored variables and values from the prompt
-        - When using stored variables, ALWAYS use the {{"variable": "variable_name"}} syntax
-        """.format(
-            tools_list="\n".join(
-                [
-                    f"- {name}: {desc}"
-                    for name, desc in [
-                        (tool["name"], tool["description"]) for tool in self._registered_tools_json
-                    ]
-                ]
-            ),
-            variables_list=variables_info,
+        system_prompt = "".join(
+            (self._SYSTEM_PROMPT_PRELUDE, variables_info, self._SYSTEM_PROMPT_EPILOGUE)
         )
+        self._system_prompt_cache = (self._variables_version, system_prompt)
+        return system_prompt
 
     def _substitute_variables(self, args: Dict[str, Any]) -> Dict[str, Any]:
         """Substitutes variable references in arguments with their actual values."""
@@ -293,60 +494,309 @@ class Agent:
                 result[key] = value
         return result
 
+    def _ensure_cached_content(
+        self,
+        system_instruction: Dict[str, Any],
+        tools: Optional[List[Dict[str, Any]]] = None,
+        tool_config: Optional[Dict[str, Any]] = None,
+        debug_scope: Optional[str] = None,
+    ) -> Optional[str]:
+        """
+        Returns the name of a cachedContents resource holding the system instruction and tools.
+
+        The cache is created lazily and re-created when its inputs change or its TTL runs out;
+        a replaced cache is deleted rather than left to expire.
+        Returns None if caching is unavailable (e.g. the content is below the minimum size
+        the API accepts), in which case the caller should send everything inline.
+        """
+        key = hashlib.md5(
+            json.dumps(
+                [self.model_name, system_instruction, tools, tool_config], sort_keys=True
+            ).encode("utf-8")
+        ).hexdigest()
+        now = time.monotonic()
+        if key == self._cache_key and now < self._cache_expiry:
+            return self._cache_name
+        if now < self._cache_retry_after:
+            return None
+
+        body: Dict[str, Any] = {
+            "model": f"models/{self.model_name}",
+            "systemInstruction": system_instruction,
+            "ttl": f"{self.context_cache_ttl}s",
+        }
+        if tools:
+            body["tools"] = tools
+        if tool_config:
+            body["toolConfig"] = tool_config
+
+        if self._cache_name and time.monotonic() < self._cache_expiry:
+            self._delete_cached_content(self._cache_name, debug_scope)
+
+        response = self._cache_http_session.post(
+            f"https://generativelanguage.googleapis.com/v1beta/cachedContents?key={self.api_key}",
+            headers=self.headers,
+            data=_json_dumps(body),
+        )
+        response_data = _json_loads(response.content)
+        self._log_text(response_data, debug_scope)
+
+        if response.ok:
+            self._cache_key = key
+            self._cache_expiry = time.monotonic() + self.context_cache_ttl - self._CACHE_EXPIRY_MARGIN
+            self._cache_name = response_data.get("name")
+        else:
+            # The key changes with every stored variable, so back off whatever it is; a
+            # rejected cache (e.g. below the minimum size) would be retried on each prompt
+            self._cache_key = None
+            self._cache_name = None
+            self._cache_retry_after = time.monotonic() + self.context_cache_ttl
+        return self._cache_name
+
+    def _delete_cached_content(self, name: str, debug_scope: Optional[str] = None) -> None:
+        """Deletes a cachedContents resource that is no longer used; failures are only logged."""
+        try:
+            response = self._cache_http_session.delete(
+                f"https://generativelanguage.googleapis.com/v1beta/{name}?key={self.api_key}",
+                headers=self.headers,
+            )
+        except requests.exceptions.RequestException as e:
+            print(f"Warning: Failed to delete cached content {name}: {e}")
+            return
+        if response.content:
+            self._log_text(_json_loads(response.content), debug_scope)
+
+    def _apply_context_cache(self, payload: Dict[str, Any], debug_scope: Optional[str] = None) -> None:
+        """
+        Points the payload at a cached copy of its system instruction and tools.
+
+        The inline fields stay in the payload so a request can fall back to them if the cache
+        goes away; _encode_payload leaves them out while cachedContent is set.
+        """
+        cache_name = self._ensure_cached_content(
+            payload["system_instruction"],
+            payload.get("tools"),
+            payload.get("toolConfig"),
+            debug_scope,
+        )
+        if cache_name:
+            payload["cachedContent"] = cache_name
+        else:
+            payload.pop("cachedContent", None)
+
+    def _context_cache_expired(self, payload: Dict[str, Any]) -> bool:
+        """Checks whether the payload references a cache whose TTL has run out."""
+        return "cachedContent" in payload and time.monotonic() >= self._cache_expiry
+
+    def _drop_context_cache(
+        self,
+        payload: Dict[str, Any],
+        response_data: Dict[str, Any],
+        debug_scope: Optional[str] = None,
+    ) -> bool:
+        """
+        Makes the payload send its system instruction and tools inline again if the API
+        rejected the cachedContent it references (e.g. the cache was evicted early).
+
+        A rejected cache the API still holds is deleted. Returns False for any other error,
+        or if the payload wasn't using a cache, in which case the caller should raise.
+        """
+        error = response_data.get("error", {})
+        status = error.get("status")
+        about_cache = "cachedcontent" in error.get("message", "").replace(" ", "").lower()
+        if status not in ("NOT_FOUND", "PERMISSION_DENIED") or not about_cache:
+            return False
+        cache_name = payload.pop("cachedContent", None)
+        if cache_name is None:
+            return False
+        if status != "NOT_FOUND":
+            self._delete_cached_content(cache_name, debug_scope)
+        if cache_name == self._cache_name:
+            self._cache_key = None
+            self._cache_name = None
+        return True
+
     def _call_gemini_api(self, payload: Dict[str, Any], debug_scope: Optional[str] = None) -> Dict[str, Any]:
         """Makes a call to the Gemini API."""
-        response = requests.post(
+        if self._context_cache_expired(payload):
+            self._apply_context_cache(payload, debug_scope)
+
+        response = self._http_session.post(
             f"{self.base_url}:generateContent?key={self.api_key}",
             headers=self.headers,
-            json=payload,
+            data=self._encode_payload(payload),
         )
-        response_data = response.json()
+        response_data = _json_loads(response.content)
         self._log_text(response_data, debug_scope)
         
         if not response.ok:
-            error_details = response_data.get('error', {})
-            error_message = f"Gemini API Error: {error_details.get('message', 'Unknown error')}"
-            if 'details' in error_details:
-                error_message += f"\nDetails: {error_details['details']}"
-            raise requests.exceptions.HTTPError(error_message, response=response)
+            # The cache can disappear before our deadline; retry once with everything inline
+            if self._drop_context_cache(payload, response_data, debug_scope):
+                return self._call_gemini_api(payload, debug_scope)
+            raise requests.exceptions.HTTPError(
+                self._api_error_message(response_data), response=response
+            )
             
         return response_data
+
+    @staticmethod
+    def _api_error_message(response_data: Dict[str, Any]) -> str:
+        """Builds the HTTPError message for a failed API call."""
+        error_details = response_data.get('error', {})
+        error_message = f"Gemini API Error: {error_details.get('message', 'Unknown error')}"
+        if 'details' in error_details:
+            error_message += f"\nDetails: {error_details['details']}"
+        return error_message
+
+    @staticmethod
+    def _create_async_http_client() -> Optional["httpx.AsyncClient"]:
+        """Creates the pooled client aprompt() uses for API calls, or None without httpx."""
+        if httpx is None:
+            return None
+        transport = httpx.AsyncHTTPTransport(
+            http2=importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(max_keepalive_connections=16),
+            retries=_MAX_RETRIES,  # Connection failures; error statuses are retried per call
+        )
+        # No timeout, same as the requests session; generation can take a while
+        return httpx.AsyncClient(transport=transport, timeout=None)
+
+    async def _get_async_http_client(self) -> Optional["httpx.AsyncClient"]:
+        """
+        Returns the running event loop's shared client for aprompt(), or None without httpx.
+
+        An httpx client is bound to one event loop, so there is one per loop rather than one
+        per agent; aprompt() calls on the same loop then reuse its open connections. The client
+        is closed when the loop shuts down its async generators, as asyncio.run() and
+        run_sync() do on exit.
+        """
+        loop = asyncio.get_running_loop()
+        entry = self._async_http_clients.get(loop)
+        if entry is not None:
+            return entry[0]
+        client = self._create_async_http_client()
+        if client is None:
+            return None
+        closer = _close_on_loop_shutdown(client)
+        self._async_http_clients[loop] = (client, closer)
+        await closer.__anext__()  # Registers the generator with the loop for shutdown
+        return client
+
+    async def _acall_gemini_api(
+        self,
+        client: Optional["httpx.AsyncClient"],
+        payload: Dict[str, Any],
+        debug_scope: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """Async version of _call_gemini_api, running it in the executor if httpx is missing."""
+        loop = asyncio.get_running_loop()
+        if client is None:
+            return await loop.run_in_executor(None, self._call_gemini_api, payload, debug_scope)
+        if self._context_cache_expired(payload):
+            # Re-creating the cache is a blocking HTTP call, so keep it off the event loop
+            await loop.run_in_executor(None, self._apply_context_cache, payload, debug_scope)
+
+        body = self._encode_payload(payload)
+        for attempt in range(_MAX_RETRIES + 1):
+            try:
+                response = await client.post(
+                    f"{self.base_url}:generateContent?key={self.api_key}",
+                    headers=self.headers,
+                    content=body,
+                )
+            except httpx.TransportError as e:
+                raise _as_requests_error(e) from e
+            if response.status_code not in _RETRY_STATUSES or attempt == _MAX_RETRIES:
+                break
+            # Same policy as the sync session's Retry, including the server's Retry-After
+            retry_after = response.headers.get("Retry-After", "")
+            await asyncio.sleep(
+                float(retry_after) if retry_after.isdigit() else _RETRY_BACKOFF * 2**attempt
+            )
+        response_data = _json_loads(response.content)
+        self._log_text(response_data, debug_scope)
+
+        if response.is_error:
+            # Dropping the cache may delete it, a blocking HTTP call
+            if await loop.run_in_executor(
+                None, self._drop_context_cache, payload, response_data, debug_scope
+            ):
+                return await self._acall_gemini_api(client, payload, debug_scope)
+            raise requests.exceptions.HTTPError(
+                self._api_error_message(response_data), response=_as_requests_response(response)
+            )
+
+        return response_data
     
+    def _encode_payload(self, payload: Dict[str, Any]) -> bytes:
+        """
+        Serializes a request payload to JSON.
+
+        Conversation entries are only ever appended while a prompt runs, so the encoding of
+        entries sent on an earlier turn is reused and only the new tail is serialized.
+
+        The other fields (system instruction, tools, configs) don't change during a prompt,
+        so they are encoded once per payload and spliced in as a fragment. While the payload
+        references a cachedContent, the fields held by that cache are left out.
+        """
+        contents = payload.get("contents", [])
+        cached = self._encoded_contents
+        if cached is not None and cached[0] is contents and len(cached[1]) <= len(contents):
+            encoded = cached[1]
+        else:
+            encoded = []
+        encoded.extend(_json_dumps(entry) for entry in contents[len(encoded) :])
+        self._encoded_contents = (contents, encoded)
+
+        cache_name = payload.get("cachedContent")
+        cached_fields = self._encoded_payload_fields
+        if (
+            cached_fields is not None
+            and cached_fields[0] is payload
+            and cached_fields[1] == cache_name
+        ):
+            fields = cached_fields[2]
+        else:
+            rest = {
+                key: value
+                for key, value in payload.items()
+                if key != "contents" and not (cache_name and key in self._CACHED_PAYLOAD_FIELDS)
+            }
+            fields = b"," + _json_dumps(rest)[1:] if rest else b"}"
+            self._encoded_payload_fields = (payload, cache_name, fields)
+
+        return b'{"contents":[' + b",".join(encoded) + b"]" + fields
+
+    @staticmethod
+    def _debug_enabled(kind: str, debug_scope: Optional[str] = None) -> bool:
+        """Checks whether a kind of debug output ("json" or "text") is enabled."""
+        return bool(debug_scope) and kind in debug_scope
+
     def _log_json(self, json_data: Dict[str, Any], file_name: str, debug_scope: Optional[str] = None) -> None:
-        """Logs the JSON data to a file."""
-        if "json" not in debug_scope:
+        """Logs the JSON data to a file in the background."""
+        if not self._debug_enabled("json", debug_scope):
             return
-        with open(file_name, "w") as f:
-            json.dump(json_data, f)
+        # Serialize now: the payload keeps changing after this call returns
+        _write_debug_file(file_name, _json_dumps(json_data))
     def _log_text(self, text: str, debug_scope: Optional[str] = None) -> None:
         """Logs the text to a file."""
-        if "text" not in debug_scope:
+        if not self._debug_enabled("text", debug_scope):
             return
         print(text)
 
-    def prompt(
+    def _build_payload(
         self,
         user_prompt: str,
         system_prompt: Optional[str] = None,
         json_format: bool = False,
         conversation_history: Optional[List[Dict[str, Any]]] = None,
         debug_scope: Optional[str] = [],
-    ) -> Any:
-        """
-        Sends a prompt to the Gemini model and processes the response.
-
-        Args:
-            user_prompt: The user's input prompt
-            system_prompt: Optional system prompt to override the default
-            json_format: If True, response will be formatted as JSON. Default is False (plain text)
-            conversation_history: Optional list of previous conversation turns
-
-        Returns:
-            The model's response, formatted as JSON if json_format is True, otherwise plain text
-        """
-        self._intermediate_results = {}
-
+    ) -> Tuple[Dict[str, Any], bool]:
+        """Builds the initial request payload and reports whether JSON formatting is deferred."""
         current_contents = conversation_history if conversation_history else []
+        # The caller may have edited the history since the last prompt, so start encoding afresh
+        self._encoded_contents = None
+        self._encoded_payload_fields = None
         
         # Add system instruction to payload
         payload: Dict[str, Any] = {
@@ -359,211 +809,506 @@ class Agent:
         # Add user prompt to contents
         payload["contents"].append({"role": "user", "parts": [{"text": user_prompt}]})
 
-        if self._registered_tools_json:
-            payload["tools"] = [{"functionDeclarations": self._registered_tools_json}]
+        tools_json = self._registered_tools_json
+        if tools_json:
+            payload["tools"] = [{"functionDeclarations": tools_json}]
             payload["toolConfig"] = {"functionCallingConfig": {"mode": "AUTO"}}
 
-        # Don't set JSON formatting initially if tools are available
-        # We'll apply it later after tool calls are completed
-        apply_json_format_later = json_format and bool(self._registered_tools_json)
+        # The API rejects response_mime_type together with function calling, so with tools
+        # we ask for JSON in the instructions and only fall back to a formatting call later
+        apply_json_format_later = json_format and bool(tools_json)
+        if apply_json_format_later:
+            payload["system_instruction"]["parts"].append({"text": self._JSON_ANSWER_INSTRUCTION})
         
         # Set JSON formatting immediately if no tools are involved
-        if json_format and not self._registered_tools_json:
+        if json_format and not tools_json:
             payload["generationConfig"] = {
                 "response_mime_type": "application/json"
             }
 
+        if self.context_cache_ttl:
+            self._apply_context_cache(payload, debug_scope)
+
+        return payload, apply_json_format_later
+
+    def _response_error(
+        self, response_data: Dict[str, Any], debug_scope: Optional[str] = []
+    ) -> Optional[Dict[str, Any]]:
+        """Returns an error dict if the API response carries no usable candidates."""
+        if "error" in response_data:
+            self._log_text(
+                f"API call failed: {response_data['error'].get('message', 'Unknown API error')}"
+                , debug_scope
+            )
+            return response_data
+
+        if not response_data.get("candidates"):
+            feedback = response_data.get("promptFeedback")
+            block_reason = feedback.get("blockReason") if feedback else "Unknown"
+            safety_ratings = feedback.get("safetyRatings") if feedback else []
+            error_msg = f"Request blocked by API. Reason: {block_reason}."
+            if safety_ratings:
+                error_msg += f" Details: {json.dumps(safety_ratings)}"
+            
+            self._log_text(error_msg, debug_scope)
+            return {"error": {"message": error_msg, "details": feedback}}
+
+        return None
+
+    def _run_function_call(
+        self, fc: Dict[str, Any], debug_scope: Optional[str] = []
+    ) -> Tuple[Dict[str, Any], Any, Optional[str]]:
+        """
+        Executes a single functionCall from the model.
+
+        Only reads agent state, so several calls may run concurrently.
+
+        Returns:
+            A tuple of (substituted arguments, function result, error message or None)
+        """
+        tool_name = fc["name"]
+        args = fc.get("args", {})
+
+        # Single lookup in the dispatch table built by _process_tools
+        tool_function = self._tool_functions.get(tool_name)
+        if tool_function is None:
+            error_msg = f"Model attempted to call unknown function '{tool_name}'."
+            self._log_text(f"Error: {error_msg}", debug_scope)
+            return args, None, error_msg
+
+        try:
+            if self._debug_enabled("text", debug_scope):
+                self._log_text(f"--- Calling Function: {tool_name}({args}) ---", debug_scope)
+
+            # Substitute both stored variables and intermediate results
+            args = self._substitute_variables(args)
+            for key, value in args.items():
+                if isinstance(value, str) and value.startswith("$"):
+                    result_key = value[1:]
+                    if result_key in self._intermediate_results:
+                        args[key] = self._intermediate_results[result_key]
+
+            # Call the function directly - it's already bound if it's a method
+            function_result = tool_function(**args)
+
+            if self._debug_enabled("text", debug_scope):
+                self._log_text(f"--- Function Result: {function_result} ---", debug_scope)
+            return args, function_result, None
+
+        except Exception as e:
+            self._log_text(f"Error executing function {tool_name}: {e}", debug_scope)
+            return args, None, f"Error during execution of tool '{tool_name}': {e}"
+
+    def _record_function_call(
+        self,
+        part: Dict[str, Any],
+        outcome: Tuple[Dict[str, Any], Any, Optional[str]],
+        contents: List[Dict[str, Any]],
+    ) -> None:
+        """Stores a function call result and appends the call and its response to the contents."""
+        contents.append({"role": "model", "parts": [part]})
+        tool_name = part["functionCall"]["name"]
+        args, function_result, error_msg = outcome
+
+        if error_msg is not None:
+            error_response_part = {
+                "functionResponse": {
+                    "name": tool_name,
+                    "response": {"error": error_msg},
+                }
+            }
+            contents.append({"role": "user", "parts": [error_response_part]})
+            return
+
+        result_key = f"result_{len(self._intermediate_results)}"
+        self._intermediate_results[result_key] = function_result
+
+        varaible_name = self.set_variable(
+            result_key,
+            function_result,
+            "the result of function call with name {tool_name} and arguments {args}",
+        )
+        function_response_part = {
+            "functionResponse": {
+                "name": tool_name,
+                "response": {
+                    "content": function_result,
+                    "key": varaible_name,
+                    "content_type": type(function_result).__name__,
+                },
+            }
+        }
+
+        contents.append(
+            {
+                "role": "user",
+                "parts": [
+                    {
+                        "text": f"the return value of the function stored in the variable {varaible_name}"
+                    }
+                ],
+            }
+        )
+
+        contents.append({"role": "user", "parts": [function_response_part]})
+
+    def _finalize_response(
+        self,
+        final_text: str,
+        payload: Dict[str, Any],
+        system_prompt: Optional[str],
+        json_format: bool,
+        apply_json_format_later: bool,
+        count: int,
+        debug_scope: Optional[str] = [],
+    ) -> Any:
+        """Turns the model's final text into the value returned by prompt()."""
+        # If JSON format is requested and we have tools, the answer is usually JSON already;
+        # only make a final formatting call if it can't be parsed locally
+        if apply_json_format_later:
+            try:
+                return _parse_json_text(final_text)
+            except json.JSONDecodeError:
+                pass
+
+            self._log_text("--- Making final JSON formatting call ---", debug_scope)
+            formatting_payload = {
+                "system_instruction": {
+                    "parts": [{"text": system_prompt if system_prompt else ""},{"text": self._get_system_prompt()}]
+                },
+                "contents": payload["contents"] + [
+                    {
+                        "role": "user",
+                        "parts": [
+                            {
+                                "text": f"Based on our conversation above, please format your response as JSON. Here is the current response: {final_text}"
+                            }
+                        ],
+                    }
+                ],
+                "generationConfig": {
+                    "response_mime_type": "application/json"
+                },
+            }
+            if self._debug_enabled("json", debug_scope):
+                self._log_json(formatting_payload, f"formatting_payload_{count}.json", debug_scope)
+            structured_response_data = self._call_gemini_api(formatting_payload, debug_scope)
+
+            if "error" in structured_response_data:
+                self._log_text(
+                    f"JSON formatting call failed: {structured_response_data['error']}. Returning raw text.",
+                    debug_scope
+                )
+                return final_text
+
+            try:
+                structured_text = structured_response_data["candidates"][0][
+                    "content"
+                ]["parts"][0]["text"]
+                structured_output = _json_loads(structured_text)
+                return structured_output
+            except (KeyError, IndexError, json.JSONDecodeError) as e:
+                self._log_text(
+                    f"Warning: Failed to parse JSON response after formatting call: {e}. Returning raw text.",
+                    debug_scope
+                )
+                return final_text
+        elif json_format:
+            # Direct JSON formatting (no tools involved)
+            try:
+                structured_output = _parse_json_text(final_text)
+                return structured_output
+            except json.JSONDecodeError as e:
+                self._log_text(
+                    f"Warning: Failed to parse JSON response: {e}. Returning raw text.",
+                    debug_scope
+                )
+                return final_text
+        else:
+            # Return plain text response
+            return final_text
+
+    def _response_cache_key(
+        self,
+        user_prompt: str,
+        system_prompt: Optional[str],
+        json_format: bool,
+        conversation_history: Optional[List[Dict[str, Any]]],
+    ) -> Optional[bytes]:
+        """Returns the response cache key for a prompt, or None if the cache is disabled."""
+        if not self.response_cache_size:
+            return None
+        return hashlib.blake2b(
+            _json_dumps(
+                [
+                    self.model_name,
+                    self._get_system_prompt(),
+                    self._registered_tools_json,
+                    user_prompt,
+                    system_prompt,
+                    json_format,
+                    conversation_history,
+                ]
+            ),
+            digest_size=16,
+        ).digest()
+
+    def _get_cached_response(
+        self, key: Optional[bytes], conversation_history: Optional[List[Dict[str, Any]]]
+    ) -> Tuple[bool, Any]:
+        """
+        Looks up a prompt result in the response cache.
+
+        On a hit, the conversation entries the original prompt added are replayed into the
+        caller's history so it ends up as if the prompt had run again.
+
+        Returns:
+            A tuple of (whether the key was found, the cached result)
+        """
+        if key is None or key not in self._response_cache:
+            return False, None
+        self._response_cache.move_to_end(key)
+        result, new_contents = self._response_cache[key]
+        if conversation_history:
+            conversation_history.extend(copy.deepcopy(new_contents))
+        return True, copy.deepcopy(result)
+
+    def _store_response(
+        self,
+        key: Optional[bytes],
+        result: Any,
+        new_contents: List[Dict[str, Any]],
+        variables_version: int,
+    ) -> None:
+        """
+        Stores a prompt result in the response cache, evicting the least recently used.
+
+        Nothing is stored if the prompt changed the stored variables (e.g. by running tools):
+        the key covers the system prompt that lists them, so it could never be hit again.
+        """
+        if key is None or variables_version != self._variables_version:
+            return
+        self._response_cache[key] = (copy.deepcopy(result), copy.deepcopy(new_contents))
+        self._response_cache.move_to_end(key)
+        while len(self._response_cache) > self.response_cache_size:
+            self._response_cache.popitem(last=False)
+
+    def _parse_error(
+        self, error: Exception, response_data: Dict[str, Any], debug_scope: Optional[str] = []
+    ) -> Dict[str, Any]:
+        """Builds the error returned when an API response has an unexpected structure."""
+        if self._debug_enabled("text", debug_scope):
+            self._log_text(f"Error parsing API response structure: {error}. Response: {response_data}", debug_scope)
+        return {
+            "error": {
+                "message": f"Error parsing API response: {error}",
+                "details": response_data,
+            }
+        }
+
+    def prompt(
+        self,
+        user_prompt: str,
+        system_prompt: Optional[str] = None,
+        json_format: bool = False,
+        conversation_history: Optional[List[Dict[str, Any]]] = None,
+        debug_scope: Optional[str] = [],
+    ) -> Any:
+        """
+        Sends a prompt to the Gemini model and processes the response.
+
+        Args:
+            user_prompt: The user's input prompt
+            system_prompt: Optional system prompt to override the default
+            json_format: If True, response will be formatted as JSON. Default is False (plain text)
+            conversation_history: Optional list of previous conversation turns
+
+        Returns:
+            The model's response, formatted as JSON if json_format is True, otherwise plain text
+        """
+        self._intermediate_results = {}
+
+        cache_key = self._response_cache_key(
+            user_prompt, system_prompt, json_format, conversation_history
+        )
+        hit, cached_result = self._get_cached_response(cache_key, conversation_history)
+        if hit:
+            return cached_result
+        history_len = len(conversation_history) if conversation_history else 0
+        variables_version = self._variables_version
+
+        payload, apply_json_format_later = self._build_payload(
+            user_prompt, system_prompt, json_format, conversation_history, debug_scope
+        )
+
         count = 0
         while True:
-            self._log_json(payload, f"payload_{count}.json", debug_scope)
+            if self._debug_enabled("json", debug_scope):
+                self._log_json(payload, f"payload_{count}.json", debug_scope)
             count += 1
             response_data = self._call_gemini_api(payload, debug_scope)
-            if "error" in response_data:
-                self._log_text(
-                    f"API call failed: {response_data['error'].get('message', 'Unknown API error')}"
-                    , debug_scope
-                )
-                return response_data
-
-            if not response_data.get("candidates"):
-                feedback = response_data.get("promptFeedback")
-                block_reason = feedback.get("blockReason") if feedback else "Unknown"
-                safety_ratings = feedback.get("safetyRatings") if feedback else []
-                error_msg = f"Request blocked by API. Reason: {block_reason}."
-                if safety_ratings:
-                    error_msg += f" Details: {json.dumps(safety_ratings)}"
-                
-                self._log_text(error_msg, debug_scope)
-                return {"error": {"message": error_msg, "details": feedback}}
-            
+            error = self._response_error(response_data, debug_scope)
+            if error:
+                return error
+
             try:
                 candidate = response_data["candidates"][0]
                 content = candidate["content"]
+                parts = content["parts"]
 
-                for part in content["parts"]:
+                # Index of the last function call, so text parts can tell if more calls follow
+                last_function_call_idx = max(
+                    (i for i, p in enumerate(parts) if "functionCall" in p), default=-1
+                )
+
+                for i, part in enumerate(parts):
                     if "functionCall" in part:
-                        payload["contents"].append({"role": "model", "parts": [part]})
-                        fc = part["functionCall"]
-                        tool_name = fc["name"]
-                        args = fc.get("args", {})
-
-                        if tool_name not in self._tool_functions:
-                            error_msg = f"Model attempted to call unknown function '{tool_name}'."
-                            self._log_text(f"Error: {error_msg}", debug_scope)
-                            error_response_part = {
-                                "functionResponse": {
-                                    "name": tool_name,
-                                    "response": {"error": error_msg},
-                                }
-                            }
-                            payload["contents"].append(
-                                {"role": "user", "parts": [error_response_part]}
+                        outcome = self._run_function_call(part["functionCall"], debug_scope)
+                        self._record_function_call(part, outcome, payload["contents"])
+
+                    elif "text" in part:
+                        # Check if there are more function calls coming
+                        has_more_function_calls = i < last_function_call_idx
+
+                        if not has_more_function_calls:
+                            result = self._finalize_response(
+                                part["text"],
+                                payload,
+                                system_prompt,
+                                json_format,
+                                apply_json_format_later,
+                                count,
+                                debug_scope,
                             )
-                            continue
+                            self._store_response(
+                                cache_key, result, payload["contents"][history_len:], variables_version
+                            )
+                            return result
+                continue
 
-                        try:
-                            tool_function = self._tool_functions[tool_name]
-                            self._log_text(f"--- Calling Function: {tool_name}({args}) ---", debug_scope)
+            except (KeyError, IndexError) as e:
+                return self._parse_error(e, response_data, debug_scope)
 
-                            # Substitute both stored variables and intermediate results
-                            args = self._substitute_variables(args)
-                            for key, value in args.items():
-                                if isinstance(value, str) and value.startswith("$"):
-                                    result_key = value[1:]
-                                    if result_key in self._intermediate_results:
-                                        args[key] = self._intermediate_results[result_key]
+        return {"error": {"message": "Exited interaction loop unexpectedly."}}
 
-                            # Call the function directly - it's already bound if it's a method
-                            function_result = tool_function(**args)
+    @staticmethod
+    def run_sync(coroutine: Coroutine[Any, Any, Any]) -> Any:
+        """
+        Runs a coroutine such as aprompt() to completion from synchronous code.
 
-                            self._log_text(f"--- Function Result: {function_result} ---", debug_scope)
+        Uses uvloop's faster event loop when it is installed.
+        """
+        if uvloop is not None:
+            return uvloop.run(coroutine)
+        return asyncio.run(coroutine)
 
-                            result_key = f"result_{len(self._intermediate_results)}"
-                            self._intermediate_results[result_key] = function_result
+    async def aprompt(
+        self,
+        user_prompt: str,
+        system_prompt: Optional[str] = None,
+        json_format: bool = False,
+        conversation_history: Optional[List[Dict[str, Any]]] = None,
+        debug_scope: Optional[str] = [],
+        max_concurrent_tools: int = 8,
+    ) -> Any:
+        """
+        Async version of prompt() that runs the function calls of each turn concurrently.
 
-                            varaible_name = self.set_variable(
-                                result_key,
-                                function_result,
-                                "the result of function call with name {tool_name} and arguments {args}",
-                            )
-                            function_response_part = {
-                                "functionResponse": {
-                                    "name": tool_name,
-                                    "response": {
-                                        "content": function_result,
-                                        "key": varaible_name,
-                                        "content_type": type(function_result).__name__,
-                                    },
-                                }
-                            }
+        API calls go through an httpx.AsyncClient when httpx is installed; otherwise they,
+        like the tools, run in the event loop's default executor so blocking work does not
+        stall the loop. Results are added to the conversation in the order the model
+        requested them. Calls within one turn cannot refer to each other's results.
 
-                            payload["contents"].append(
-                                {
-                                    "role": "user",
-                                    "parts": [
-                                        {
-                                            "text": f"the return value of the function stored in the variable {varaible_name}"
-                                        }
-                                    ],
-                                }
-                            )
+        Errors are raised as the same requests exceptions prompt() raises, with httpx too: an
+        HTTPError carries a requests.Response, and transport failures become ConnectionError
+        or Timeout.
 
-                            payload["contents"].append(
-                                {"role": "user", "parts": [function_response_part]}
-                            )
+        Args:
+            user_prompt: The user's input prompt
+            system_prompt: Optional system prompt to override the default
+            json_format: If True, response will be formatted as JSON. Default is False (plain text)
+            conversation_history: Optional list of previous conversation turns
+            max_concurrent_tools: Maximum number of tools executed at the same time
 
-                        except Exception as e:
-                            self._log_text(f"Error executing function {tool_name}: {e}", debug_scope)
-                            error_msg = f"Error during execution of tool '{tool_name}': {e}"
-                            error_response_part = {
-                                "functionResponse": {
-                                    "name": tool_name,
-                                    "response": {"error": error_msg},
-                                }
-                            }
-                            payload["contents"].append(
-                                {"role": "user", "parts": [error_response_part]}
-                            )
-                            continue
+        Returns:
+            The model's response, formatted as JSON if json_format is True, otherwise plain text
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(max_concurrent_tools)
 
-                    elif "text" in part:
-                        final_text = part["text"]
+        async def run_function_call(fc: Dict[str, Any]) -> Tuple[Dict[str, Any], Any, Optional[str]]:
+            async with semaphore:
+                return await loop.run_in_executor(None, self._run_function_call, fc, debug_scope)
 
-                        # Check if there are more function calls coming
-                        has_more_function_calls = any(
-                            "functionCall" in p
-                            for p in content["parts"][content["parts"].index(part) + 1 :]
-                        )
+        self._intermediate_results = {}
 
-                        if not has_more_function_calls:
-                            # If JSON format is requested and we have tools, make a final formatting call
-                            if apply_json_format_later:
-                                self._log_text("--- Making final JSON formatting call ---", debug_scope)
-                                formatting_payload = {
-                                    "system_instruction": {
-                                        "parts": [{"text": system_prompt if system_prompt else ""},{"text": self._get_system_prompt()}]
-                                    },
-                                    "contents": payload["contents"] + [
-                                        {
-                                            "role": "user",
-                                            "parts": [
-                                                {
-                                                    "text": f"Based on our conversation above, please format your response as JSON. Here is the current response: {final_text}"
-                                                }
-                                            ],
-                                        }
-                                    ],
-                                    "generationConfig": {
-                                        "response_mime_type": "application/json"
-                                    },
-                                }
-                                self._log_json(formatting_payload, f"formatting_payload_{count}.json", debug_scope)
-                                count += 1
-                                structured_response_data = self._call_gemini_api(formatting_payload, debug_scope)
-
-                                if "error" in structured_response_data:
-                                    self._log_text(
-                                        f"JSON formatting call failed: {structured_response_data['error']}. Returning raw text.",
-                                        debug_scope
-                                    )
-                                    return final_text
-
-                                try:
-                                    structured_text = structured_response_data["candidates"][0][
-                                        "content"
-                                    ]["parts"][0]["text"]
-                                    structured_output = json.loads(structured_text)
-                                    return structured_output
-                                except (KeyError, IndexError, json.JSONDecodeError) as e:
-                                    self._log_text(
-                                        f"Warning: Failed to parse JSON response after formatting call: {e}. Returning raw text.",
-                                        debug_scope
-                                    )
-                                    return final_text
-                            elif json_format:
-                                # Direct JSON formatting (no tools involved)
-                                try:
-                                    structured_output = json.loads(final_text)
-                                    return structured_output
-                                except json.JSONDecodeError as e:
-                                    self._log_text(
-                                        f"Warning: Failed to parse JSON response: {e}. Returning raw text.",
-                                        debug_scope
-                                    )
-                                    return final_text
-                            else:
-                                # Return plain text response
-                                return final_text
-                continue
+        cache_key = self._response_cache_key(
+            user_prompt, system_prompt, json_format, conversation_history
+        )
+        hit, cached_result = self._get_cached_response(cache_key, conversation_history)
+        if hit:
+            return cached_result
+        history_len = len(conversation_history) if conversation_history else 0
+        variables_version = self._variables_version
+
+        payload, apply_json_format_later = await loop.run_in_executor(
+            None,
+            partial(
+                self._build_payload,
+                user_prompt,
+                system_prompt,
+                json_format,
+                conversation_history,
+                debug_scope,
+            ),
+        )
 
-            except (KeyError, IndexError) as e:
-                self._log_text(f"Error parsing API response structure: {e}. Response: {response_data}", debug_scope)
-                return {
-                    "error": {
-                        "message": f"Error parsing API response: {e}",
-                        "details": response_data,
-                    }
-                }
+        client = await self._get_async_http_client()
+        count = 0
+        while True:
+            if self._debug_enabled("json", debug_scope):
+                self._log_json(payload, f"payload_{count}.json", debug_scope)
+            count += 1
+            response_data = await self._acall_gemini_api(
+                client, payload, debug_scope
+            )
+            error = self._response_error(response_data, debug_scope)
+            if error:
+                return error
 
-        return {"error": {"message": "Exited interaction loop unexpectedly."}}
+            try:
+                parts = response_data["candidates"][0]["content"]["parts"]
+                function_call_idxs = [i for i, part in enumerate(parts) if "functionCall" in part]
+                function_call_parts = [parts[i] for i in function_call_idxs]
+
+                outcomes = await asyncio.gather(
+                    *(run_function_call(part["functionCall"]) for part in function_call_parts)
+                )
+                for part, outcome in zip(function_call_parts, outcomes):
+                    self._record_function_call(part, outcome, payload["contents"])
+
+                # Text after the last function call is the final answer
+                last_function_call_idx = function_call_idxs[-1] if function_call_idxs else -1
+                for part in parts[last_function_call_idx + 1 :]:
+                    if "text" in part:
+                        result = await loop.run_in_executor(
+                            None,
+                            partial(
+                                self._finalize_response,
+                                part["text"],
+                                payload,
+                                system_prompt,
+                                json_format,
+                                apply_json_format_later,
+                                count,
+                                debug_scope,
+                            ),
+                        )
+                        self._store_response(
+                            cache_key, result, payload["contents"][history_len:], variables_version
+                        )
+                        return result
+                continue
 
+            except (KeyError, IndexError) as e:
+                return self._parse_error(e, response_data, debug_scope)
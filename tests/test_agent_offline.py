@@ -0,0 +1,629 @@
+"""Unit tests that exercise the agent without calling the Gemini API."""
+
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+import requests
+
+from gemini_agent import Agent
+from gemini_agent import agent as agent_module
+from gemini_agent.agent import _parse_json_text
+from vertex_agent import Agent as VertexAgent
+from vertex_agent import agent as vertex_agent_module
+
+
+class FakeResponse:
+    """Stands in for a requests.Response carrying a JSON body."""
+
+    def __init__(self, data, status_code=200):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.content = json.dumps(data).encode("utf-8")
+
+
+class FakeSession:
+    """Replays canned responses (or callables returning one) and records each request body."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = []  # (method, url, decoded JSON body or None)
+        self.sent_headers = []  # Copy of the headers sent with each call
+
+    def post(self, url, headers=None, data=None):
+        self.calls.append(("POST", url, json.loads(data)))
+        self.sent_headers.append(dict(headers or {}))
+        response = self.responses.pop(0)
+        return response() if callable(response) else response
+
+    def delete(self, url, headers=None):
+        self.calls.append(("DELETE", url, None))
+        self.sent_headers.append(dict(headers or {}))
+        return FakeResponse({})
+
+
+def text_response(text):
+    return FakeResponse({"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]})
+
+
+def function_call_response(*calls):
+    parts = [{"functionCall": {"name": name, "args": args}} for name, args in calls]
+    return FakeResponse({"candidates": [{"content": {"role": "model", "parts": parts}}]})
+
+
+@pytest.fixture
+def fake_session(monkeypatch):
+    """Installs a FakeSession as the shared HTTP sessions; queue responses on it."""
+    session = FakeSession([])
+    for agent_class in (Agent, VertexAgent):
+        monkeypatch.setattr(agent_class, "_http_session", session)
+        monkeypatch.setattr(agent_class, "_cache_http_session", session)
+    return session
+
+
+@Agent.description("Multiplies two numbers.")
+@Agent.parameters(
+    {
+        "a": {"type": int, "description": "The first number"},
+        "b": {"type": int, "description": "The second number"},
+    }
+)
+def multiply(a: int, b: int) -> int:
+    return a * b
+
+
+def test_system_prompt_tracks_variables():
+    """Test that the cached system prompt is rebuilt when variables change."""
+    agent = Agent(api_key="test-key")
+
+    first_prompt = agent._get_system_prompt()
+    assert agent._get_system_prompt() is first_prompt
+
+    agent.set_variable("user_id", 7, "The current user")
+    assert "- user_id: The current user (Type: int)" in agent._get_system_prompt()
+
+
+def test_parse_json_text():
+    """Test that JSON answers are parsed with or without a Markdown code fence."""
+    assert _parse_json_text('{"count": 2}') == {"count": 2}
+    assert _parse_json_text('```json\n{"count": 2}\n```') == {"count": 2}
+
+    with pytest.raises(json.JSONDecodeError):
+        _parse_json_text("There are 2 input tags.")
+
+
+def test_context_cache_keeps_history_inline_and_deletes_replaced_cache(fake_session):
+    """Test that only the system instruction and tools are cached, and stale caches are deleted."""
+    agent = Agent(api_key="test-key", tools=[multiply], context_cache_ttl=300)
+    history = [{"role": "user", "parts": [{"text": "Hello"}]}]
+    fake_session.responses = [
+        FakeResponse({"name": "cachedContents/first"}),
+        function_call_response(("multiply", {"a": 3, "b": 7})),
+        text_response("21"),
+        # The stored result variable changes the system prompt, so the cache is replaced
+        FakeResponse({"name": "cachedContents/second"}),
+        text_response("Done"),
+    ]
+
+    assert agent.prompt("Multiply 3 and 7", conversation_history=history) == "21"
+    assert agent.prompt("Thanks", conversation_history=history) == "Done"
+
+    methods = [method for method, _, _ in fake_session.calls]
+    assert methods == ["POST", "POST", "POST", "DELETE", "POST", "POST"]
+    first_cache, second_cache = fake_session.calls[0][2], fake_session.calls[4][2]
+    assert "contents" not in first_cache and "contents" not in second_cache
+    assert fake_session.calls[3][1].startswith(
+        "https://generativelanguage.googleapis.com/v1beta/cachedContents/first?"
+    )
+
+    last_request = fake_session.calls[5][2]
+    assert last_request["cachedContent"] == "cachedContents/second"
+    assert "system_instruction" not in last_request
+    assert last_request["contents"][0] == {"role": "user", "parts": [{"text": "Hello"}]}
+    assert last_request["contents"][-1] == {"role": "user", "parts": [{"text": "Thanks"}]}
+
+
+def test_context_cache_backs_off_after_failure(fake_session):
+    """Test that a rejected cache isn't retried on later prompts, even if the system prompt changed."""
+    agent = Agent(api_key="test-key", tools=[multiply], context_cache_ttl=300)
+    fake_session.responses = [
+        FakeResponse({"error": {"message": "Cached content is too small"}}, status_code=400),
+        function_call_response(("multiply", {"a": 2, "b": 5})),
+        text_response("10"),
+        text_response("Done"),
+    ]
+
+    assert agent.prompt("Multiply 2 and 5") == "10"
+    assert agent.prompt("Thanks") == "Done"
+
+    urls = [url for _, url, _ in fake_session.calls]
+    assert sum("cachedContents" in url for url in urls) == 1
+    for _, _, body in fake_session.calls[1:]:
+        assert "cachedContent" not in body
+        assert "system_instruction" in body and "tools" in body
+
+
+@pytest.mark.parametrize(
+    "status_code, status, deleted",
+    [(403, "PERMISSION_DENIED", True), (404, "NOT_FOUND", False)],
+)
+def test_context_cache_falls_back_inline_when_rejected(fake_session, status_code, status, deleted):
+    """Test that a request whose cache was rejected is retried inline and the cache deleted."""
+    agent = Agent(api_key="test-key", tools=[multiply], context_cache_ttl=300)
+    error = {"code": status_code, "message": "CachedContent not found (or permission denied)", "status": status}
+    fake_session.responses = [
+        FakeResponse({"name": "cachedContents/gone"}),
+        FakeResponse({"error": error}, status_code=status_code),
+        text_response("Hi"),
+    ]
+
+    assert agent.prompt("Hello") == "Hi"
+
+    requests_sent = [call for call in fake_session.calls if call[0] == "POST"]
+    rejected, retried = requests_sent[1][2], requests_sent[2][2]
+    assert rejected["cachedContent"] == "cachedContents/gone"
+    assert "system_instruction" not in rejected and "tools" not in rejected
+    assert "cachedContent" not in retried
+    assert "system_instruction" in retried and "tools" in retried
+    assert retried["contents"] == rejected["contents"]
+
+    deletes = [url for method, url, _ in fake_session.calls if method == "DELETE"]
+    assert len(deletes) == (1 if deleted else 0)
+    assert all("/cachedContents/gone?" in url for url in deletes)
+
+
+def test_context_cache_does_not_retry_other_errors(fake_session):
+    """Test that an ordinary bad request made with a cache is raised, not resent inline."""
+    agent = Agent(api_key="test-key", tools=[multiply], context_cache_ttl=300)
+    error = {"code": 400, "message": "Invalid JSON payload received.", "status": "INVALID_ARGUMENT"}
+    fake_session.responses = [
+        FakeResponse({"name": "cachedContents/kept"}),
+        FakeResponse({"error": error}, status_code=400),
+    ]
+
+    with pytest.raises(requests.exceptions.HTTPError, match="Invalid JSON payload"):
+        agent.prompt("Hello")
+
+    assert [method for method, _, _ in fake_session.calls] == ["POST", "POST"]
+    assert agent._cache_name == "cachedContents/kept"
+
+
+@pytest.mark.parametrize("context_cache_ttl", [5, -1])
+def test_context_cache_rejects_ttls_within_the_expiry_margin(context_cache_ttl):
+    """Test that a TTL that would expire the cache before it is used is refused."""
+    with pytest.raises(ValueError, match="context_cache_ttl"):
+        Agent(api_key="test-key", context_cache_ttl=context_cache_ttl)
+
+
+def test_cache_creation_is_not_retried_after_server_errors():
+    """Test that cachedContents creates, unlike generateContent calls, don't retry POSTs."""
+    request_retries = Agent._http_session.get_adapter("https://example.com").max_retries
+    cache_retries = Agent._cache_http_session.get_adapter("https://example.com").max_retries
+
+    assert "POST" in request_retries.allowed_methods
+    assert "POST" not in cache_retries.allowed_methods
+    assert "DELETE" in cache_retries.allowed_methods
+
+
+def test_context_cache_is_refreshed_when_it_expires_mid_prompt(fake_session):
+    """Test that a tool loop outliving the cache TTL switches to a new cache."""
+    agent = Agent(api_key="test-key", tools=[multiply], context_cache_ttl=300)
+
+    def expire_cache_then(response):
+        def respond():
+            agent._cache_expiry = 0.0
+            return response
+
+        return respond
+
+    fake_session.responses = [
+        FakeResponse({"name": "cachedContents/old"}),
+        expire_cache_then(function_call_response(("multiply", {"a": 4, "b": 4}))),
+        FakeResponse({"name": "cachedContents/new"}),
+        text_response("16"),
+    ]
+
+    assert agent.prompt("Multiply 4 and 4") == "16"
+
+    assert [url.rsplit("?", 1)[0].rsplit("/", 1)[-1] for _, url, _ in fake_session.calls] == [
+        "cachedContents",
+        "gemini-1.5-flash:generateContent",
+        "cachedContents",
+        "gemini-1.5-flash:generateContent",
+    ]
+    assert fake_session.calls[3][2]["cachedContent"] == "cachedContents/new"
+
+
+def mock_async_client(monkeypatch, responses):
+    """Makes aprompt() use an httpx client that replays (status, JSON body) pairs."""
+    httpx = pytest.importorskip("httpx")
+    statuses = []
+
+    def handler(request):
+        status, data = responses.pop(0)
+        statuses.append(status)
+        return httpx.Response(status, json=data)
+
+    monkeypatch.setattr(agent_module, "_RETRY_BACKOFF", 0.0)
+    monkeypatch.setattr(
+        Agent,
+        "_create_async_http_client",
+        staticmethod(lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler))),
+    )
+    return statuses
+
+
+def test_aprompt_retries_transient_errors(monkeypatch):
+    """Test that aprompt() retries 429/5xx responses like the sync session does."""
+    unavailable = {"error": {"message": "Try again"}}
+    answer = {"candidates": [{"content": {"role": "model", "parts": [{"text": "Hi"}]}}]}
+    statuses = mock_async_client(monkeypatch, [(429, unavailable), (503, unavailable), (200, answer)])
+    agent = Agent(api_key="test-key")
+
+    assert asyncio.run(agent.aprompt("Hello")) == "Hi"
+    assert statuses == [429, 503, 200]
+
+
+def test_aprompt_error_carries_the_response(monkeypatch):
+    """Test that an API error from aprompt() exposes the response, as prompt()'s does."""
+    unavailable = {"error": {"message": "Quota exceeded"}}
+    statuses = mock_async_client(monkeypatch, [(429, unavailable)] * 3)
+    agent = Agent(api_key="test-key")
+
+    async def call_api():
+        async with Agent._create_async_http_client() as client:
+            return await agent._acall_gemini_api(client, {"contents": []})
+
+    with pytest.raises(requests.exceptions.HTTPError, match="Quota exceeded") as excinfo:
+        asyncio.run(call_api())
+    response = excinfo.value.response
+    assert isinstance(response, requests.Response)
+    assert (response.status_code, response.ok, response.reason) == (429, False, "Too Many Requests")
+    assert response.json() == unavailable
+    assert statuses == [429, 429, 429]
+
+
+def test_aprompt_maps_transport_errors_to_requests_exceptions(monkeypatch):
+    """Test that httpx connection failures surface as the requests exceptions prompt() raises."""
+    httpx = pytest.importorskip("httpx")
+
+    def refuse(request):
+        raise httpx.ConnectError("Connection refused", request=request)
+
+    transport = httpx.MockTransport(refuse)
+    monkeypatch.setattr(
+        Agent, "_create_async_http_client", staticmethod(lambda: httpx.AsyncClient(transport=transport))
+    )
+    agent = Agent(api_key="test-key")
+
+    with pytest.raises(requests.exceptions.ConnectionError, match="Connection refused"):
+        asyncio.run(agent.aprompt("Hello"))
+
+
+def check_request_bodies(monkeypatch, agent):
+    """Asserts each spliced request body decodes to exactly the payload it was built from."""
+    bodies = []
+    encode_payload = agent._encode_payload
+
+    def checked_encode_payload(payload):
+        body = encode_payload(payload)
+        uses_cache = "cachedContent" in payload
+        expected = {
+            key: value
+            for key, value in payload.items()
+            if not (uses_cache and key in Agent._CACHED_PAYLOAD_FIELDS)
+        }
+        assert json.loads(body) == json.loads(json.dumps(expected))
+        bodies.append(json.loads(body))
+        return body
+
+    monkeypatch.setattr(agent, "_encode_payload", checked_encode_payload)
+    return bodies
+
+
+@pytest.mark.parametrize("context_cache_ttl", [None, 300])
+def test_request_body_matches_payload_over_tool_loop(monkeypatch, fake_session, context_cache_ttl):
+    """Test that incrementally encoded bodies match the payload on every turn and prompt."""
+    agent = Agent(api_key="test-key", tools=[multiply], context_cache_ttl=context_cache_ttl)
+    bodies = check_request_bodies(monkeypatch, agent)
+    history = [{"role": "user", "parts": [{"text": "Hello"}]}, {"role": "model", "parts": [{"text": "Hi"}]}]
+    cache_responses = [FakeResponse({"name": "cachedContents/first"})] if context_cache_ttl else []
+    fake_session.responses = cache_responses + [
+        function_call_response(("multiply", {"a": 2, "b": 3})),
+        function_call_response(("multiply", {"a": {"variable": "result_0"}, "b": 4})),
+        text_response("24"),
+    ]
+
+    assert agent.prompt("Multiply 2 by 3, then by 4", conversation_history=history) == "24"
+    assert [len(body["contents"]) for body in bodies] == [3, 6, 9]
+    assert all(("cachedContent" in body) == bool(context_cache_ttl) for body in bodies)
+    assert all(("system_instruction" in body) != bool(context_cache_ttl) for body in bodies)
+
+    # Editing an earlier entry between prompts must not reuse the previous prompt's encoding
+    history[1]["parts"][0]["text"] = "Hi there"
+    cache_responses = [FakeResponse({"name": "cachedContents/second"})] if context_cache_ttl else []
+    fake_session.responses = cache_responses + [text_response("Bye")]
+
+    assert agent.prompt("Bye", conversation_history=history) == "Bye"
+    assert len(bodies) == 4
+    assert bodies[-1]["contents"][1] == {"role": "model", "parts": [{"text": "Hi there"}]}
+    assert bodies[-1]["contents"][-1] == {"role": "user", "parts": [{"text": "Bye"}]}
+
+
+def test_response_cache_hits_and_misses(fake_session):
+    """Test that a repeated prompt is answered from the cache and a new one is not."""
+    agent = Agent(api_key="test-key", response_cache_size=2)
+    fake_session.responses = [text_response("First"), text_response("Second")]
+
+    assert agent.prompt("Question one") == "First"
+    assert agent.prompt("Question one") == "First"
+    assert agent.prompt("Question two") == "Second"
+    assert len(fake_session.calls) == 2
+
+
+def test_response_cache_evicts_least_recently_used(fake_session):
+    """Test that the cache holds response_cache_size results and evicts the least recently used."""
+    agent = Agent(api_key="test-key", response_cache_size=2)
+    fake_session.responses = [text_response("A"), text_response("B"), text_response("C"), text_response("B again")]
+
+    agent.prompt("a")
+    agent.prompt("b")
+    agent.prompt("a")  # Hit; "b" is now the least recently used
+    agent.prompt("c")  # Evicts "b"
+    assert len(agent._response_cache) == 2
+
+    assert agent.prompt("a") == "A"
+    assert agent.prompt("b") == "B again"
+    assert len(fake_session.calls) == 4
+
+
+def test_response_cache_replays_history_and_isolates_copies(fake_session):
+    """Test that a hit extends the caller's history and that cached values can't be mutated."""
+    agent = Agent(api_key="test-key", response_cache_size=4)
+    fake_session.responses = [text_response('{"count": 2}')]
+    first_history = [{"role": "user", "parts": [{"text": "Hello"}]}]
+    second_history = [{"role": "user", "parts": [{"text": "Hello"}]}]
+
+    first = agent.prompt("Count the tags", json_format=True, conversation_history=first_history)
+    assert first == {"count": 2}
+    first["count"] = 99
+    first_history[-1]["parts"][0]["text"] = "Edited"
+
+    second = agent.prompt("Count the tags", json_format=True, conversation_history=second_history)
+    assert second == {"count": 2}
+    assert second_history == [
+        {"role": "user", "parts": [{"text": "Hello"}]},
+        {"role": "user", "parts": [{"text": "Count the tags"}]},
+    ]
+    assert len(fake_session.calls) == 1
+
+    second["count"] = 42
+    second_history[-1]["parts"][0]["text"] = "Edited"
+    third_history = [{"role": "user", "parts": [{"text": "Hello"}]}]
+    assert agent.prompt("Count the tags", json_format=True, conversation_history=third_history) == {"count": 2}
+    assert third_history[-1] == {"role": "user", "parts": [{"text": "Count the tags"}]}
+
+
+def test_response_cache_does_not_store_errors(fake_session):
+    """Test that an error result is returned but not cached, so the prompt is retried."""
+    agent = Agent(api_key="test-key", response_cache_size=2)
+    fake_session.responses = [FakeResponse({"promptFeedback": {"blockReason": "SAFETY"}}), text_response("Fine")]
+
+    assert "error" in agent.prompt("Question")
+    assert agent.prompt("Question") == "Fine"
+    assert len(fake_session.calls) == 2
+
+
+class ConcurrencyTracker:
+    """Counts how many tool calls are running at once."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def __enter__(self):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+    def __exit__(self, *exc_info):
+        with self._lock:
+            self.running -= 1
+
+
+square_tracker = ConcurrencyTracker()  # Replaced with a fresh tracker by each test
+
+
+@Agent.description("Squares a number slowly.")
+@Agent.parameters({"x": {"type": int, "description": "The number to square"}})
+def slow_square(x: int) -> int:
+    with square_tracker:
+        time.sleep(0.05 * (5 - x))  # Later calls finish first
+    return x * x
+
+
+@pytest.mark.parametrize("max_concurrent_tools, expected_max_running", [(8, 4), (2, 2)])
+def test_aprompt_runs_function_calls_concurrently_in_order(
+    monkeypatch, fake_session, max_concurrent_tools, expected_max_running
+):
+    """Test that aprompt() runs a turn's function calls at once, bounded and recorded in order."""
+    monkeypatch.setattr(Agent, "_create_async_http_client", staticmethod(lambda: None))
+    tracker = ConcurrencyTracker()
+    monkeypatch.setitem(globals(), "square_tracker", tracker)
+    agent = Agent(api_key="test-key", tools=[slow_square])
+    fake_session.responses = [
+        function_call_response(*[("slow_square", {"x": x}) for x in (1, 2, 3, 4)]),
+        text_response("Done"),
+    ]
+
+    result = asyncio.run(agent.aprompt("Square 1 to 4", max_concurrent_tools=max_concurrent_tools))
+
+    assert result == "Done"
+    assert tracker.max_running == expected_max_running
+    contents = fake_session.calls[1][2]["contents"]
+    calls = [
+        part["functionCall"]["args"]["x"]
+        for entry in contents
+        for part in entry["parts"]
+        if "functionCall" in part
+    ]
+    responses = [
+        part["functionResponse"]["response"]["content"]
+        for entry in contents
+        for part in entry["parts"]
+        if "functionResponse" in part
+    ]
+    assert calls == [1, 2, 3, 4]
+    assert responses == [1, 4, 9, 16]
+
+
+def test_aprompt_reuses_one_client_per_event_loop(monkeypatch):
+    """Test that aprompt() calls on one loop share an httpx client that closes with the loop."""
+    httpx = pytest.importorskip("httpx")
+    answer = {"candidates": [{"content": {"role": "model", "parts": [{"text": "Hi"}]}}]}
+    clients = []
+
+    def create_client():
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, json=answer))
+        clients.append(httpx.AsyncClient(transport=transport))
+        return clients[-1]
+
+    monkeypatch.setattr(Agent, "_create_async_http_client", staticmethod(create_client))
+    agent, other_agent = Agent(api_key="test-key"), Agent(api_key="other-key")
+
+    async def prompt_three_times():
+        return [await agent.aprompt("Hello"), await agent.aprompt("Again"), await other_agent.aprompt("Hi")]
+
+    assert asyncio.run(prompt_three_times()) == ["Hi", "Hi", "Hi"]
+    assert len(clients) == 1
+    assert clients[0].is_closed
+
+    asyncio.run(agent.aprompt("New loop"))
+    assert len(clients) == 2
+    assert clients[1].is_closed
+
+
+def test_response_cache_skips_prompts_that_ran_tools(fake_session):
+    """Test that results of tool-using prompts, whose keys can't recur, don't take cache slots."""
+    agent = Agent(api_key="test-key", tools=[multiply], response_cache_size=1)
+    fake_session.responses = [
+        text_response("Hi"),
+        function_call_response(("multiply", {"a": 2, "b": 3})),
+        text_response("6"),
+        function_call_response(("multiply", {"a": 2, "b": 3})),
+        text_response("6"),
+    ]
+
+    assert agent.prompt("Hello") == "Hi"
+    assert agent.prompt("Multiply 2 and 3") == "6"
+    assert [result for result, _ in agent._response_cache.values()] == ["Hi"]
+
+    # The stored result variable changed the key, so a repeat has to call the API anyway
+    assert agent.prompt("Multiply 2 and 3") == "6"
+    assert len(fake_session.calls) == 5
+    assert [result for result, _ in agent._response_cache.values()] == ["Hi"]
+
+
+class FakeCredentials:
+    """Stands in for service-account credentials, handing out a new token on each refresh."""
+
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self.token = None
+        self.refreshes = 0
+
+    def refresh(self, request):
+        self.refreshes += 1
+        self.token = f"{self.project_id}-token-{self.refreshes}"
+
+
+@pytest.fixture
+def vertex_credentials(monkeypatch):
+    """Loads FakeCredentials for "<project>.json" key paths; maps each key path to them."""
+    loaded = {}
+
+    def from_service_account_file(key_path, scopes=None):
+        loaded[key_path] = FakeCredentials(key_path.split(".")[0])
+        return loaded[key_path]
+
+    monkeypatch.setattr(
+        vertex_agent_module.service_account.Credentials,
+        "from_service_account_file",
+        staticmethod(from_service_account_file),
+    )
+    return loaded
+
+
+def test_vertex_access_token_is_refreshed_only_when_needed(fake_session, vertex_credentials):
+    """Test that the OAuth token is reused across prompts until it expires or the project changes."""
+    agent = VertexAgent(key_path="project-a.json")
+    fake_session.responses = [text_response(f"Answer {i}") for i in range(5)]
+
+    for i in range(3):
+        assert agent.prompt(f"Question {i}") == f"Answer {i}"
+    assert vertex_credentials["project-a.json"].refreshes == 1
+
+    agent._token_expiry = 0.0  # The token is about to run out
+    agent.prompt("Question 3")
+    assert vertex_credentials["project-a.json"].refreshes == 2
+
+    agent.set_project("project-b.json")
+    agent.prompt("Question 4")
+    assert vertex_credentials["project-a.json"].refreshes == 2
+    assert vertex_credentials["project-b.json"].refreshes == 1
+    assert agent._get_access_token() == "project-b-token-1"
+
+
+def test_vertex_requests_share_headers_that_follow_token_rotation(fake_session, vertex_credentials):
+    """Test that the reused headers dict carries the current token, also for cache requests."""
+    agent = VertexAgent(key_path="project-a.json", context_cache_ttl=300)
+    headers = agent.headers
+    fake_session.responses = [
+        FakeResponse({"name": "projects/project-a/locations/us-central1/cachedContents/first"}),
+        text_response("Hi"),
+        # The new variable changes the system prompt, so the cache is replaced
+        FakeResponse({"name": "projects/project-a/locations/us-central1/cachedContents/second"}),
+        text_response("Hi again"),
+    ]
+
+    agent.prompt("Hello")
+    agent._token_expiry = 0.0  # Rotate the token before the next prompt
+    agent.set_variable("user_id", 7, "The current user")
+    agent.prompt("Hello again")
+
+    assert agent.headers is headers
+    assert headers["Authorization"] == "Bearer project-a-token-2"
+    sent = [
+        (method, url.split("/v1/")[1].split("/locations/")[1], request_headers["Authorization"])
+        for (method, url, _), request_headers in zip(fake_session.calls, fake_session.sent_headers)
+    ]
+    assert sent == [
+        ("POST", "us-central1/cachedContents", "Bearer project-a-token-1"),
+        ("POST", "us-central1/publishers/google/models/gemini-1.5-flash:generateContent", "Bearer project-a-token-1"),
+        ("DELETE", "us-central1/cachedContents/first", "Bearer project-a-token-2"),
+        ("POST", "us-central1/cachedContents", "Bearer project-a-token-2"),
+        ("POST", "us-central1/publishers/google/models/gemini-1.5-flash:generateContent", "Bearer project-a-token-2"),
+    ]
+
+
+def test_vertex_config_override_builds_and_reuses_url(fake_session, vertex_credentials):
+    """Test that a config override targets its model and region, and its URL is memoized."""
+    agent = VertexAgent(key_path="project-a.json")
+    config = {"model_name": "gemini-1.5-pro", "region": "europe-west4"}
+    fake_session.responses = [text_response("Hi"), text_response("Hi again")]
+    expected_url = (
+        "https://europe-west4-aiplatform.googleapis.com/v1/projects/project-a/locations/"
+        "europe-west4/publishers/google/models/gemini-1.5-pro:generateContent"
+    )
+
+    agent.prompt("Hello", config=config)
+    cached_urls = dict(agent._url_cache)
+    agent.prompt("Hello again", config=config)
+
+    assert [url for _, url, _ in fake_session.calls] == [expected_url, expected_url]
+    assert agent._url_cache == cached_urls
+    assert cached_urls[("project-a", "europe-west4", "gemini-1.5-pro")] == expected_url
+    assert agent._build_url("europe-west4", "gemini-1.5-pro") is cached_urls[("project-a", "europe-west4", "gemini-1.5-pro")]